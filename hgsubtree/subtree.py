@@ -6,8 +6,7 @@ from mercurial import hg, util, commands, cmdutil, error, localrepo, ui as uimod
 from mercurial.i18n import _
 from hgext     import strip
 
-import os, ConfigParser
-from fnmatch     import fnmatch
+import os, re, errno, fnmatch, hashlib, itertools, multiprocessing
 from collections import defaultdict
 
 # configurable via subtree/hgsubtree in hgrc
@@ -16,6 +15,12 @@ default_bookmark_prefix  = 'subtree@'
 default_move_comment     = 'subtree: move {name}'
 default_merge_comment    = 'subtree: update {name}'
 default_collapse_comment = 'subtree: {name}@{rev}'
+default_cache_dir        = os.path.join('~', '.cache', 'hgsubtree')
+
+# destination directive opcodes, assigned once in _destinations
+OP_MKDIR, OP_MV, OP_CP, OP_RM, OP_KEEP = range(5)
+_destination_ops = { 'mkdir': OP_MKDIR, 'mv': OP_MV, 'cp': OP_CP,
+                     'rm': OP_RM, 'keep': OP_KEEP }
 
 cmdtable = {}
 command = registrar.command(cmdtable)
@@ -42,6 +47,8 @@ def subpull(ui, repo, name = '', **opts):
     # parse .hgsubtree
     hgsubtree = ui.config('subtree', 'hgsubtree', default = default_hgsubtree)
     subtrees = _parse_hgsubtree(os.path.join(repo.root, hgsubtree))
+    if ui.debugflag:        # don't build the repr unless it will be shown
+        ui.debug('subtree config: %r\n' % (subtrees,))
 
     # if names not in .hgsubtree, abort
     # if names is empty, go through all repos in .hgsubtree
@@ -54,153 +61,367 @@ def subpull(ui, repo, name = '', **opts):
             raise error.Abort("Cannot use --source without specifying a repository")
         names = subtrees.keys()
 
-    null = repo['null']
-    origin = str(repo[None])
+    # binary node of the working directory parent; cheaper than building a
+    # workingctx and hex-slicing its string form, and accepted directly by
+    # hg.updaterepo/hg.merge
+    origin = repo.dirstate.p1()
     commit_opts = { 'edit': opts['edit'] }
     bookmark_prefix = ui.config('subtree', 'bookmark', default = default_bookmark_prefix)
     nocache = ui.config('subtree', 'nocache', default = '')
+    # look the message templates up once; ui.config walks the layered
+    # configuration on every call
+    move_tpl     = ui.config('subtree', 'move', default_move_comment)
+    merge_tpl    = ui.config('subtree', 'merge', default_merge_comment)
+    collapse_tpl = ui.config('subtree', 'collapse', default_collapse_comment)
+    mkdir_seen = set()      # directories already created for the current subtree
+
+    def _do_mkdir(ui, repo, args):
+        if args[0] in mkdir_seen:
+            return
+        try:
+            os.makedirs(args[0])
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        mkdir_seen.add(args[0])
+
+    # destination directives dispatch on their opcode, not on repeated
+    # string comparisons
+    dispatch = { OP_MKDIR: _do_mkdir, OP_MV: _do_mv, OP_CP: _do_cp, OP_RM: _do_rm }
+
+    # warm the cache repos for all subtrees up front; these pulls are
+    # network-bound, independent of one another, and never touch the working
+    # copy, so they can run in parallel child processes while the
+    # merges below stay sequential in this process
+    cache_path = os.path.expanduser(ui.config('subtree', 'cache', default = default_cache_dir))
+    prefetched = set()
+    if not nocache and len(names) > 1:
+        tasks = []
+        task_ids = set()
+        for n in names:
+            sub = subtrees[n]
+            if not sub.source:
+                continue
+            # subtrees sharing one upstream share one cache entry; a single
+            # worker must warm it, or the workers race the init in
+            # _clone_or_pull.  The other sharers take the sequential path
+            # below, which is an incremental pull from the warm cache.
+            cid = _cache_id(sub.source)
+            if cid in task_ids:
+                continue
+            task_ids.add(cid)
+            task_opts = {}
+            if sub.rev:
+                task_opts['rev'] = [sub.rev]
+            if opts['rev']:
+                task_opts['rev'] = opts['rev']
+            tasks.append((cache_path, n, sub.source, task_opts))
+        if len(tasks) > 1:
+            pool = multiprocessing.Pool(min(len(tasks), multiprocessing.cpu_count()))
+            try:
+                for n, err in pool.imap_unordered(_prefetch_worker, tasks):
+                    if err is None:
+                        prefetched.add(n)
+                    else:
+                        # fall back to the sequential pull below
+                        ui.warn("prefetch of %s failed: %s\n" % (n, err))
+            finally:
+                pool.close()
+                pool.join()
 
     for name in names:
-        subtree = subtrees[name]
-        if 'destination' not in subtree:
-            raise error.Abort('No destination found for %s' % name)
-
-        collapse = 'collapse' in subtree and subtree['collapse']
-
-        # figure out the revision to pull
-        pull_opts = {}
-        if 'rev' in subtree:
-            pull_opts['rev'] = [subtree['rev']]
-        if opts['rev']:
-            pull_opts['rev'] = opts['rev']
-
-        # clone or pull into cache
-        source = subtree['source'] if not opts['source'] else opts['source']
-        if not nocache:
-            source = _clone_or_pull(ui, repo, name, source, pull_opts)
-
-        # pull
-        tip = repo['tip']
-        commands.pull(ui, repo, source = source, force = True, **pull_opts)
-        if tip == repo['tip']:
-            ui.status("no changes: nothing for subtree to do\n")
-            continue
-
-        # collapse or update -C
-        if collapse:
-            # find a matching bookmark
-            bookmark_name = bookmark_prefix + name
-            if bookmark_name in repo._bookmarks:
-                commands.update(ui, repo, bookmark_name, clean = True)
-            else:
-                commands.update(ui, repo, 'null', clean = True)
+        # hold the wlock across the whole iteration, so the commands below
+        # share one acquisition instead of each taking and releasing it
+        with repo.wlock():
+            subtree = subtrees[name]
+            if subtree.destination is None:
+                raise error.Abort('No destination found for %s' % name)
+
+            collapse = subtree.collapse
+
+            # figure out the revision to pull
+            pull_opts = {}
+            if subtree.rev:
+                pull_opts['rev'] = [subtree.rev]
+            if opts['rev']:
+                pull_opts['rev'] = opts['rev']
+
+            # clone or pull into cache, unless the prefetch already did
+            source = subtree.source if not opts['source'] else opts['source']
+            if not nocache:
+                if name in prefetched:
+                    source = os.path.join(cache_path, _cache_id(source))
+                else:
+                    source = _clone_or_pull(ui, cache_path, name, source, pull_opts)
 
-            # set up the correct file state and commit as a new changeset
+            # pull
+            tip = repo['tip']
+            commands.pull(ui, repo, source = source, force = True, **pull_opts)
             pulled_tip = repo['tip']
-            commands.revert(ui, repo, rev = 'tip', all = True)
-            hgsubrepo_meta = [os.path.join(repo.root, '.hgsubstate'),
-                              os.path.join(repo.root, '.hgsub')]
-            for fn in hgsubrepo_meta:
-                if os.path.exists(fn):
-                    ui.debug("removing %s\n" % fn)
-                    commands.remove(ui, repo, fn, force = True)
-                    os.remove(fn)
-            changed = commands.commit(ui, repo,
-                                      message=ui.config('subtree', 'collapse', default_collapse_comment).format(name=name, rev=str(pulled_tip)[:12]),
-                                      **commit_opts)
-            commands.bookmark(ui, repo, bookmark_name, inactive=True)
-
-            if not opts['no_strip']:
-                # delete bookmarks on the changesets that will be stripped; not
-                # the most efficient procedure to find them, but will do for now
-                remove_bookmarks = []
-                for k in repo._bookmarks.keys():
-                    ctx = repo[k]
-                    if pulled_tip.ancestor(ctx) != null:
-                        remove_bookmarks.append(k)
-
-                for bookmark in remove_bookmarks:
-                    commands.bookmark(ui, repo, bookmark, delete = True)
-
-                strip.stripcmd(ui, repo, rev = ['ancestors(%s)' % str(pulled_tip)], bookmark = [])
-
-            if changed == 1:    # nothing changed
+            if tip == pulled_tip:
                 ui.status("no changes: nothing for subtree to do\n")
-                commands.update(ui, repo, origin[:12])
                 continue
-        else:
-            commands.update(ui, repo, 'tip', clean = True)
-
-        # move or delete
-        destinations = _destinations(subtree['destination'])
-
-        # process destinations
-        keep_list = []
-        for dest in destinations:
-            if dest[0] == 'mkdir':
-                if not os.path.exists(dest[1]):
-                    os.makedirs(dest[1])
-            elif dest[0] == 'mv':
-                commands.rename(ui, repo, *dest[1:], force = False)
-            elif dest[0] == 'cp':
-                commands.copy(ui, repo, *dest[1:], force = False)
-            elif dest[0] == 'rm':
-                commands.remove(ui, repo, *dest[1:], force = False)
-            elif dest[0] == 'keep':
-                keep_list.append(' '.join(dest[1:]))
-
-        # remove all untouched files, unless instructed to keep them
-        if 'keep' not in subtree or not subtree['keep']:
-            _modified, _added, _removed, _deleted, _unknown, _ignored, clean = repo.status(clean = True)
-            for fn in clean:
-                for keep_pattern in keep_list:
-                    if fnmatch(fn, keep_pattern):
-                        break
+
+            # collapse or update -C
+            if collapse:
+                # find a matching bookmark
+                bookmark_name = bookmark_prefix + name
+                bookmarks = repo._bookmarks     # lazy property; resolve it once
+                if bookmark_name in bookmarks:
+                    hg.updaterepo(repo, bookmark_name, overwrite = True)
                 else:
-                    commands.remove(ui, repo, fn)
+                    hg.updaterepo(repo, 'null', overwrite = True)
+
+                # set up the correct file state and commit as a new changeset
+                commands.revert(ui, repo, rev = 'tip', all = True)
+                hgsubrepo_meta = [os.path.join(repo.root, '.hgsubstate'),
+                                  os.path.join(repo.root, '.hgsub')]
+                for fn in hgsubrepo_meta:
+                    try:
+                        os.remove(fn)
+                    except OSError as e:
+                        if e.errno != errno.ENOENT:
+                            raise
+                    else:
+                        ui.debug("removing %s\n" % fn)
+                        commands.remove(ui, repo, fn, force = True, after = True)
+                changed = commands.commit(ui, repo,
+                                          message=collapse_tpl.format(name=name, rev=str(pulled_tip)[:12]),
+                                          **commit_opts)
+                commands.bookmark(ui, repo, bookmark_name, inactive=True)
+
+                if not opts['no_strip']:
+                    # delete bookmarks on the changesets that will be stripped;
+                    # the strip removes the whole connected component around
+                    # the pulled tip (descendants of its ancestry), not just
+                    # the tip's own ancestors, so match that exact set
+                    strip_revs = set(repo.revs('(::%n)::', pulled_tip.node()))
+                    remove_bookmarks = [k for k, n in bookmarks.items()
+                                        if repo[n].rev() in strip_revs]
+                    if remove_bookmarks:
+                        commands.bookmark(ui, repo, *remove_bookmarks, delete = True)
+
+                    strip.stripcmd(ui, repo, rev = ['ancestors(%s)' % str(pulled_tip)], bookmark = [])
+
+                if changed == 1:    # nothing changed
+                    ui.status("no changes: nothing for subtree to do\n")
+                    hg.updaterepo(repo, origin, overwrite = False)
+                    continue
+            else:
+                hg.updaterepo(repo, 'tip', overwrite = True)
 
-        commands.commit(ui, repo,
-                        message=ui.config('subtree', 'move', default_move_comment).format(name=name),
-                        **commit_opts)
-        merge_commit = str(repo[None])
+            # move or delete
+            destinations = _destinations(subtree.destination)
 
-        # update to original and merge with the new
-        commands.update(ui, repo, origin[:12])
-        commands.merge(ui, repo, merge_commit[:12])
-        commands.commit(ui, repo,
-                        message=ui.config('subtree', 'merge', default_merge_comment).format(name=name),
-                        **commit_opts)
-        origin = str(repo[None])
+            # the clean updates above may have deleted directories created
+            # for a previous subtree, so start from scratch each iteration
+            mkdir_seen.clear()
 
-def _parse_hgsubtree(fn):
-    config = ConfigParser.SafeConfigParser()
-    config.read(fn)
+            # process destinations
+            keep_list = []
+            for dest in destinations:
+                if dest[0] == OP_KEEP:
+                    keep_list.append(' '.join(dest[1:]))
+                else:
+                    dispatch[dest[0]](ui, repo, dest[1:])
+
+            # remove all untouched files, unless instructed to keep them
+            if not subtree.keep:
+                # patterns of the form dir/* or dir/** dominate in practice
+                # and reduce to a literal prefix (fnmatch's * matches across
+                # slashes); test those with one C-level startswith and fall
+                # back to a union regex for anything with real glob syntax
+                keep_prefixes = []
+                keep_globs = []
+                for p in keep_list:
+                    head = p.rstrip('*')
+                    if p.endswith('*') and head.endswith('/') and not any(c in head for c in '*?['):
+                        keep_prefixes.append(head)
+                    else:
+                        keep_globs.append(p)
+                keep_prefixes = tuple(keep_prefixes)
+                keep_re = _glob_union(keep_globs) if keep_globs else None
+                # untouched files are the wdir parent's manifest entries not
+                # touched by the moves/copies above; reading the manifest is much
+                # cheaper than having status enumerate every clean file on disk
+                modified, added, removed, deleted, _unknown, _ignored, _clean = repo.status()
+                touched = set(itertools.chain(modified, added, removed, deleted))
+                remove_list = []
+                for fn in repo[None].p1().manifest():
+                    if fn in touched:
+                        continue
+                    if keep_prefixes and fn.startswith(keep_prefixes):
+                        continue
+                    if keep_re is not None and keep_re.match(fn):
+                        continue
+                    remove_list.append(fn)
+                if remove_list:
+                    commands.remove(ui, repo, *remove_list)
+
+            commands.commit(ui, repo,
+                            message=move_tpl.format(name=name),
+                            **commit_opts)
+            merge_commit = repo.dirstate.p1()
+
+            # update to original and merge with the new
+            hg.updaterepo(repo, origin, overwrite = False)
+            hg.merge(repo, merge_commit)
+            commands.commit(ui, repo,
+                            message=merge_tpl.format(name=name),
+                            **commit_opts)
+            origin = repo.dirstate.p1()
+
+class _Subtree(object):
+    """A parsed .hgsubtree section, with every field resolved and coerced
+    once, so subpull probes attributes instead of hashing dict keys."""
+
+    __slots__ = ('source', 'destination', 'rev', 'collapse', 'keep')
+
+    def __init__(self, items):
+        self.source      = items.get('source')
+        self.destination = items.get('destination')
+        self.rev         = items.get('rev')
+        self.collapse    = items.get('collapse', '').lower() in ('1', 'true', 'yes', 'on')
+        self.keep        = items.get('keep', '').lower() in ('1', 'true', 'yes', 'on')
+
+    def __repr__(self):
+        return '_Subtree(source=%r, destination=%r, rev=%r, collapse=%r, keep=%r)' % \
+               (self.source, self.destination, self.rev, self.collapse, self.keep)
+
+# cache of parsed .hgsubtree files: fn -> (mtime, size, result)
+_hgsubtree_cache = {}
 
+def _parse_hgsubtree(fn):
+    try:
+        st = os.stat(fn)
+    except OSError:        # missing file parses as an empty config
+        return {}
+    cached = _hgsubtree_cache.get(fn)
+    if cached is not None and cached[0] == (st.st_mtime, st.st_size):
+        return cached[1]
+
+    # hand-rolled scanner for the simple section/key=value format used here;
+    # much cheaper than ConfigParser, which compiles regexes per line
     result = {}
-    for s in config.sections():
-        result[s] = dict(config.items(s))
-
+    section = None
+    key = None
+    with open(fn, 'r') as f:
+        for line in f:
+            stripped = line.strip()
+            if not stripped or stripped[0] in ';#':
+                continue
+            if line[0] in ' \t' and key is not None:
+                # indented continuation of a multi-line value
+                result[section][key] += '\n' + stripped
+                continue
+            if stripped[0] == '[':
+                section = stripped[1:stripped.index(']')]
+                result[section] = {}
+                key = None
+                continue
+            eq, colon = stripped.find('='), stripped.find(':')
+            sep = '=' if colon < 0 or (0 <= eq < colon) else ':'
+            k, _sep, v = stripped.partition(sep)
+            key = k.strip().lower()
+            result[section][key] = v.strip()
+
+    result = dict((s, _Subtree(items)) for s, items in result.items())
+    _hgsubtree_cache[fn] = ((st.st_mtime, st.st_size), result)
     return result
 
+# translated globs and compiled unions, shared across subpull invocations so
+# repeated runs never re-enter fnmatch.translate for the same patterns
+_glob_cache = {}
+_glob_union_cache = {}
+
+def _glob_union(pats):
+    """Compiled regex matching any of the glob patterns."""
+    key = tuple(pats)
+    r = _glob_union_cache.get(key)
+    if r is None:
+        parts = []
+        for p in pats:
+            t = _glob_cache.get(p)
+            if t is None:
+                t = fnmatch.translate(p)
+                _glob_cache[p] = t
+            parts.append(t)
+        r = re.compile('|'.join(parts))
+        _glob_union_cache[key] = r
+    return r
+
+def _do_mv(ui, repo, args):
+    commands.rename(ui, repo, *args, force = False)
+
+def _do_cp(ui, repo, args):
+    commands.copy(ui, repo, *args, force = False)
+
+def _do_rm(ui, repo, args):
+    commands.remove(ui, repo, *args, force = False)
+
 def _destinations(s):
     res = []
     for x in s.split('\n'):
-        x = x.strip()
-        if len(x) == 0: continue
-        res.append([y.strip() for y in x.split(' ')])
+        # bare split handles runs of whitespace (including tabs) in one
+        # C-level scan and never yields empty tokens
+        tokens = x.split()
+        if not tokens or tokens[0].startswith('#'):
+            continue
+        op = _destination_ops.get(tokens[0])
+        if op is None: continue     # unknown directives have always been ignored
+        res.append((op,) + tuple(tokens[1:]))
     return res
 
-def _clone_or_pull(ui, repo, name, source, pull_opts):
-    cache_path = os.path.join(repo.path, 'subtree-cache')
-    if not os.path.exists(cache_path):
+# only a full hash pins a revision; bookmark and branch names can move upstream
+_fullhex_re = re.compile('[0-9a-f]{40}$')
+
+def _cache_id(source):
+    # hash the source URL so the cache directory name leaks no credentials
+    # embedded in it, and so one cache entry serves every consumer repo;
+    # local paths are made absolute first (subpull runs from the repo root),
+    # so the same relative source in different repos names different entries
+    if '://' not in source:
+        source = os.path.abspath(source)
+    return hashlib.sha256(source).hexdigest()
+
+def _clone_or_pull(ui, cache_path, name, source, pull_opts):
+    # tolerate concurrent creation: on a cold cache every prefetch worker
+    # reaches here at the same time
+    try:
         os.makedirs(cache_path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
 
-    subrepo_cache = os.path.join(cache_path, name)
+    subrepo_cache = os.path.join(cache_path, _cache_id(source))
     if not os.path.exists(subrepo_cache):
         os.makedirs(subrepo_cache)
         ui.status("initializing clean cache repo for %s in %s\n" % (name, subrepo_cache))
         commands.init(ui, subrepo_cache)
     cache_repo = hg.repository(ui, path = subrepo_cache)
+
+    # a revision pinned by full hash and already in the cache needs no network
+    revs = pull_opts.get('rev')
+    if revs:
+        rev = revs[0] if isinstance(revs, list) else revs
+        if _fullhex_re.match(rev):
+            try:
+                cache_repo[rev]
+                return subrepo_cache
+            except error.RepoLookupError:
+                pass
     commands.pull(ui, cache_repo, source = source, **pull_opts)
 
     return subrepo_cache
+
+def _prefetch_worker(args):
+    """Pull one subtree's upstream into its cache repo.  Runs in a child
+    process, so it builds its own ui instead of sharing the parent's."""
+    cache_path, name, source, pull_opts = args
+    try:
+        lui = uimod.ui.load()
+        lui.setconfig('ui', 'quiet', True, 'subtree')
+        _clone_or_pull(lui, cache_path, name, source, pull_opts)
+    except Exception as e:
+        return (name, str(e))
+    return (name, None)